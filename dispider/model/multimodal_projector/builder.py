@@ -5,9 +5,16 @@ import torch.nn.functional as F
 import re
 import math
 import numpy as np
-import random
 from .modeling_sampler import BertConfig, BertLMHeadModel
 
+try:
+    # fused kernel that keeps the input dtype, falls back to torch when apex or its
+    # cuda extension (python-only installs) is missing
+    import fused_layer_norm_cuda  # noqa: F401
+    from apex.normalization import FusedLayerNorm as LayerNorm
+except ImportError:
+    LayerNorm = nn.LayerNorm
+
 
 class IdentityMap(nn.Module):
     def __init__(self):
@@ -24,7 +31,7 @@ class IdentityMap(nn.Module):
 class SimpleResBlock(nn.Module):
     def __init__(self, channels):
         super().__init__()
-        self.pre_norm = nn.LayerNorm(channels)
+        self.pre_norm = LayerNorm(channels)
 
         self.proj = nn.Sequential(
             nn.Linear(channels, channels),
@@ -39,7 +46,7 @@ class SimpleResBlock(nn.Module):
 class SlotAttention(nn.Module):
     """Slot Attention module."""
 
-    def __init__(self, num_slots, encoder_dims, iters=3, hidden_dim=128, out_dim=128, eps=1e-4):
+    def __init__(self, num_slots, encoder_dims, iters=3, hidden_dim=128, out_dim=128, eps=1e-4, compile_step=False):
         """Builds the Slot Attention module.
         Args:
             iters: Number of iterations.
@@ -47,6 +54,7 @@ class SlotAttention(nn.Module):
             encoder_dims: Dimensionality of slot feature vectors.
             hidden_dim: Hidden layer size of MLP.
             eps: Offset for attention coefficients before normalization.
+            compile_step: Run each iteration through torch.compile (needs Triton).
         """
         super(SlotAttention, self).__init__()
         
@@ -54,9 +62,11 @@ class SlotAttention(nn.Module):
         self.iters = iters
         self.num_slots = num_slots
         self.scale = encoder_dims ** -0.5
-        self.norm_input = nn.LayerNorm(encoder_dims)
-        self.norm_slots = nn.LayerNorm(encoder_dims)
-        self.norm_pre_ff = nn.LayerNorm(encoder_dims)
+        self.norm_input = LayerNorm(encoder_dims)
+        # norms inside the compiled step stay traceable, apex's C extension would break the graph
+        step_norm = nn.LayerNorm if compile_step else LayerNorm
+        self.norm_slots = step_norm(encoder_dims)
+        self.norm_pre_ff = step_norm(encoder_dims)
 
         self.slots_embedding = nn.Parameter(torch.randn(1, num_slots, encoder_dims))
         self.project_q = nn.Linear(encoder_dims, encoder_dims)
@@ -72,6 +82,8 @@ class SlotAttention(nn.Module):
 
         self.head = nn.Linear(encoder_dims, out_dim)
 
+        self.compile_step = compile_step
+
     def forward(self, inputs):
         # inputs has shape [batch_size, num_inputs, inputs_size].
         inputs = self.norm_input(inputs)  # Apply layer norm to the input.
@@ -86,22 +98,9 @@ class SlotAttention(nn.Module):
         init_slots = self.slots_embedding.expand(b, -1, -1)
         slots = init_slots
         # Multiple rounds of attention.
+        step = self._compiled_step if self.compile_step else SlotAttention._step
         for t in range(self.iters):
-            slots_prev = slots
-            slots = self.norm_slots(slots)
-
-            # Attention.
-            q = self.project_q(slots)  # Shape: [batch_size, num_slots, slot_size].
-            dots = torch.einsum('bid,bjd->bij', q, k) * self.scale
-            attn = dots.softmax(dim=1) + self.eps
-            attn = attn / attn.sum(dim=-1, keepdim=True)  # weighted mean.
-
-            updates = torch.einsum('bjd,bij->bid', v, attn)
-            # `updates` has shape: [batch_size, num_slots, slot_size].
-
-            # Slot update.
-            slots = slots_prev + updates
-            slots = slots + self.mlp(self.norm_pre_ff(slots))
+            slots = step(self, slots, k, v)
             if t == self.iters-2:
                 slots = slots.detach() - init_slots.detach() + init_slots
 
@@ -109,6 +108,32 @@ class SlotAttention(nn.Module):
 
         return output
 
+    def _step(self, slots, k, v):
+        """One round of slot attention, compiled with compile_step so the norm/softmax/residual ops fuse."""
+        slots_prev = slots
+        slots = self.norm_slots(slots)
+
+        # Attention.
+        q = self.project_q(slots)  # Shape: [batch_size, num_slots, slot_size].
+        # scale is folded into the GEMM, the empty input is ignored with beta=0
+        dots = torch.baddbmm(
+            q.new_empty(q.shape[0], q.shape[1], k.shape[1]), q, k.transpose(1, 2), beta=0, alpha=self.scale)
+        attn = dots.softmax(dim=1)
+        # weighted mean, sum_j(attn + eps) == sum_j(attn) + n * eps so the shifted matrix is never reduced
+        attn = (attn + self.eps) / (attn.sum(dim=-1, keepdim=True) + attn.shape[-1] * self.eps)
+
+        updates = torch.bmm(attn, v)
+        # `updates` has shape: [batch_size, num_slots, slot_size].
+
+        # Slot update.
+        slots = slots_prev + updates
+        slots = slots + self.mlp(self.norm_pre_ff(slots))
+        return slots
+
+    # compiled once per class and called with an explicit self, so nothing instance-bound is stored
+    # and deepcopy / pickling of the module keep working
+    _compiled_step = staticmethod(torch.compile(_step))
+
 
 class PerceiverSampler(nn.Module):
 
@@ -122,7 +147,7 @@ class PerceiverSampler(nn.Module):
             layer.output = None
             layer.intermediate = None
         self.Qformer.cls = None
-        self.ln_vision = nn.LayerNorm(num_vision_features)
+        self.ln_vision = LayerNorm(num_vision_features)
         self.head = nn.Linear(self.Qformer.config.hidden_size, out_size)
 
     @classmethod
@@ -147,7 +172,7 @@ class PerceiverSampler(nn.Module):
     def forward(self, inputs):
         image_embeds = self.ln_vision(inputs)
         image_atts = torch.ones(image_embeds.size()[:-1],
-                                dtype=torch.long).to(inputs.device)
+                                dtype=torch.long, device=inputs.device)
         query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
         query_output = self.Qformer.bert(
             query_embeds=query_tokens,
@@ -165,34 +190,62 @@ class MultiProjector(nn.Module):
         super(MultiProjector, self).__init__()
         self.mlp = mlp
         self.sa = sa
+        # side stream for the sa branch, created lazily so the module can be built without cuda
+        self._sa_stream = None
 
     def forward(self, inputs, projector=None):
         if not self.training:
             output = self.mlp(inputs)
             return output
 
-        idx_mlp = torch.where(projector==0)[0]
-        idx_sa = torch.where(projector==1)[0]
-        feat_mlp = self.mlp(inputs)
-        feat_sa = self.sa(inputs)
+        # make sure both branches get at least one sample, without syncing to the host:
+        # a random sample is sent to mlp if none is, otherwise to sa if none is
+        has_mlp = projector[:, 0].eq(0).any()
+        has_sa = projector[:, 0].eq(1).any()
+        r = torch.randint(projector.shape[0], (1,), device=projector.device)
+        projector[r, 0] = torch.where(has_mlp & has_sa, projector[r, 0], has_mlp.to(projector.dtype))
+
+        idx_mlp = projector[:, 0].eq(0).nonzero(as_tuple=True)[0].to(inputs.device)
+        idx_sa = projector[:, 0].eq(1).nonzero(as_tuple=True)[0].to(inputs.device)
+
+        # only run each branch on the samples routed to it
+        inputs_mlp = inputs.index_select(0, idx_mlp)
+        inputs_sa = inputs.index_select(0, idx_sa)
+        if inputs.is_cuda:
+            # the branches are independent, overlap sa on a side stream with mlp on the current one
+            main_stream = torch.cuda.current_stream(inputs.device)
+            sa_stream = self._get_sa_stream(inputs.device)
+            sa_stream.wait_stream(main_stream)
+            with torch.cuda.stream(sa_stream):
+                feat_sa = self.sa(inputs_sa)
+            feat_mlp = self.mlp(inputs_mlp)
+            main_stream.wait_stream(sa_stream)
+            inputs_sa.record_stream(sa_stream)
+            feat_sa.record_stream(main_stream)
+        else:
+            feat_mlp = self.mlp(inputs_mlp)
+            feat_sa = self.sa(inputs_sa)
 
-        if len(idx_mlp) == 0:
-            projector[random.randint(0, projector.shape[0]-1), 0] = 0
-        elif len(idx_sa) == 0:
-            projector[random.randint(0, projector.shape[0]-1), 0] = 1
-        
-        idx_mlp = torch.where(projector==0)[0]
-        idx_sa = torch.where(projector==1)[0]
-
-        output = []
-        for i in range(inputs.shape[0]):
-            if i in idx_mlp:
-                output.append(feat_mlp[i])
-            if i in idx_sa:
-                output.append(feat_sa[i])
-        assert len(output) == inputs.shape[0]
+        if feat_mlp.shape[1:] == feat_sa.shape[1:]:
+            output = feat_mlp.new_empty(inputs.shape[0], *feat_mlp.shape[1:])
+            output.index_copy_(0, idx_mlp, feat_mlp)
+            output.index_copy_(0, idx_sa, feat_sa)
+            return output
+
+        # branches disagree on the token count, fall back to a per-sample list
+        output = [None] * inputs.shape[0]
+        for i, feat in zip(idx_mlp.tolist(), feat_mlp):
+            output[i] = feat
+        for i, feat in zip(idx_sa.tolist(), feat_sa):
+            output[i] = feat
+        assert all(feat is not None for feat in output)
         return output
 
+    def _get_sa_stream(self, device):
+        if self._sa_stream is None or self._sa_stream.device != device:
+            self._sa_stream = torch.cuda.Stream(device=device)
+        return self._sa_stream
+
 
 def get_abs_pos(abs_pos, tgt_size):
     # abs_pos: L, C
@@ -203,8 +256,11 @@ def get_abs_pos(abs_pos, tgt_size):
     dtype = abs_pos.dtype
 
     if src_size != tgt_size:
+        # bicubic runs natively in half precision on cuda, only upcast elsewhere
+        if dtype != torch.float32 and not (abs_pos.is_cuda and dtype in (torch.float16, torch.bfloat16)):
+            abs_pos = abs_pos.float()
         return F.interpolate(
-            abs_pos.float().reshape(1, src_size, src_size, -1).permute(0, 3, 1, 2),
+            abs_pos.reshape(1, src_size, src_size, -1).permute(0, 3, 1, 2),
             size=(tgt_size, tgt_size),
             mode="bicubic",
             align_corners=False,
@@ -263,6 +319,85 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     return emb
 
 
+@torch.no_grad()
+def get_2d_sincos_pos_embed_torch(embed_dim, grid_size, cls_token=False, device='cpu'):
+    """
+    torch counterpart of get_2d_sincos_pos_embed, built directly on `device`
+    return:
+    pos_embed: [grid_size*grid_size, embed_dim] or [1+grid_size*grid_size, embed_dim] (w/ or w/o cls_token)
+    """
+    assert embed_dim % 2 == 0
+    grid_h = torch.arange(grid_size, dtype=torch.float32, device=device)
+    grid_w = torch.arange(grid_size, dtype=torch.float32, device=device)
+    grid = torch.meshgrid(grid_w, grid_h, indexing='xy')  # here w goes first
+
+    emb_h = get_1d_sincos_pos_embed_from_grid_torch(embed_dim // 2, grid[0])  # (H*W, D/2)
+    emb_w = get_1d_sincos_pos_embed_from_grid_torch(embed_dim // 2, grid[1])  # (H*W, D/2)
+    pos_embed = torch.cat([emb_h, emb_w], dim=1) # (H*W, D)
+    if cls_token:
+        pos_embed = torch.cat([pos_embed.new_zeros(1, embed_dim), pos_embed], dim=0)
+    return pos_embed
+
+
+@torch.no_grad()
+def get_1d_sincos_pos_embed_from_grid_torch(embed_dim, pos):
+    """
+    embed_dim: output dimension for each position
+    pos: a tensor of positions to be encoded: size (M,)
+    out: (M, D)
+    """
+    assert embed_dim % 2 == 0
+    omega = torch.arange(embed_dim // 2, dtype=torch.float32, device=pos.device)
+    omega /= embed_dim / 2.
+    omega = 1. / 10000**omega  # (D/2,)
+
+    out = torch.outer(pos.reshape(-1), omega)  # (M, D/2)
+    return torch.cat([out.sin(), out.cos()], dim=1)  # (M, D)
+
+
+class CrossAttention(nn.Module):
+    """
+    Batch-first replacement for nn.MultiheadAttention backed by
+        F.scaled_dot_product_attention (flash / memory-efficient kernels).
+        Parameter names match nn.MultiheadAttention so existing checkpoints load as is.
+    """
+    def __init__(self, embed_dim, num_heads):
+        super().__init__()
+        assert embed_dim % num_heads == 0
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+    def forward(self, query, key, value, attn_mask=None):
+        # query: b l c, key/value: b s c
+        b, l, _ = query.shape
+        s = key.shape[1]
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+        q = F.linear(query, w_q, b_q).view(b, l, self.num_heads, self.head_dim).transpose(1, 2)
+        k = F.linear(key, w_k, b_k).view(b, s, self.num_heads, self.head_dim).transpose(1, 2)
+        v = F.linear(value, w_v, b_v).view(b, s, self.num_heads, self.head_dim).transpose(1, 2)
+
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                # nn.MultiheadAttention masks out True positions, SDPA keeps them
+                attn_mask = ~attn_mask
+            if attn_mask.dim() == 3:
+                attn_mask = attn_mask.view(b, self.num_heads, l, s)
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        out = out.transpose(1, 2).reshape(b, l, self.embed_dim)
+        return self.out_proj(out)
+
+
 class Resampler(nn.Module):
     """
     A 2D perceiver-resampler network with one cross attention layers by
@@ -276,18 +411,23 @@ class Resampler(nn.Module):
             embed_dim,
             num_heads,
             kv_dim=None,
-            norm_layer=nn.LayerNorm
+            norm_layer=LayerNorm,
+            tgt_sizes=None
     ):
         super().__init__()
         self.num_queries = grid_size ** 2
         self.embed_dim = embed_dim
         self.num_heads = num_heads
 
-        self.pos_embed = nn.Parameter(
-            torch.from_numpy(get_2d_sincos_pos_embed(embed_dim, grid_size)).float()
-        ).requires_grad_(False)
+        self.register_buffer(
+            'pos_embed', get_2d_sincos_pos_embed_torch(embed_dim, grid_size))
+        # interpolate pos_embed up front for grid sizes known to come from the vision tower
+        for size in tgt_sizes or []:
+            self.register_buffer(f'pos_embed_{size}', get_abs_pos(self.pos_embed, size * size), persistent=False)
+        # (tgt_size, dtype, device) -> (key pos_embed, query pos_embed)
+        self._pos_embed_cache = {}
 
-        self.query = nn.Parameter(torch.zeros(self.num_queries, embed_dim))
+        self.query = nn.Parameter(torch.empty(self.num_queries, embed_dim))
         trunc_normal_(self.query, std=.02)
 
         if kv_dim is not None and kv_dim != embed_dim:
@@ -295,7 +435,7 @@ class Resampler(nn.Module):
         else:
             self.kv_proj = nn.Identity()
 
-        self.attn = nn.MultiheadAttention(embed_dim, num_heads)
+        self.attn = CrossAttention(embed_dim, num_heads)
         self.ln_q = norm_layer(embed_dim)
         self.ln_kv = norm_layer(embed_dim)
 
@@ -309,31 +449,50 @@ class Resampler(nn.Module):
             trunc_normal_(m.weight, std=.02)
             if isinstance(m, nn.Linear) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
+        elif isinstance(m, (nn.LayerNorm, LayerNorm)):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
     def forward(self, x, attn_mask=None):
 
-        pos_embed = get_abs_pos(self.pos_embed, x.size(1))
+        pos_embed, query_pos_embed = self._get_pos_embed(x.size(1), x.dtype, x.device)
 
         x = self.kv_proj(x)
-        x = self.ln_kv(x).permute(1, 0, 2) # b n c -> n b c
+        x = self.ln_kv(x)
 
-        N = x.shape[1]
+        N = x.shape[0]
         q = self.ln_q(self.query)
         out = self.attn(
-            self._repeat(q, N) + self.pos_embed.to(x.dtype).unsqueeze(1),
-            x + pos_embed.to(x.dtype).unsqueeze(1),
+            self._repeat(q, N) + query_pos_embed,
+            x + pos_embed,
             x,
-            attn_mask=attn_mask)[0]
-        out = out.permute(1, 0, 2)
+            attn_mask=attn_mask)
         out = self.ln_post(out)
         out = out @ self.proj
         return out
 
     def _repeat(self, query, N: int):
-        return query.unsqueeze(1).repeat(1, N, 1)
+        return query.unsqueeze(0).expand(N, -1, -1)
+
+    def _get_pos_embed(self, tgt_size, dtype, device):
+        key = (tgt_size, dtype, device)
+        if key not in self._pos_embed_cache:
+            pos_embed = getattr(self, f'pos_embed_{int(math.sqrt(tgt_size))}', None)
+            if pos_embed is None:
+                pos_embed = get_abs_pos(self.pos_embed, tgt_size)
+            self._pos_embed_cache[key] = (
+                pos_embed.to(device=device, dtype=dtype).unsqueeze(0),
+                self.pos_embed.to(device=device, dtype=dtype).unsqueeze(0),
+            )
+        return self._pos_embed_cache[key]
+
+    def _apply(self, *args, **kwargs):
+        self._pos_embed_cache.clear()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._pos_embed_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
 
 
 class QwenResampler(nn.Module):
@@ -351,18 +510,23 @@ class QwenResampler(nn.Module):
             kv_dim=None,
             tgt_embed_dim=None,
             src_kv_dim=None,
-            norm_layer=nn.LayerNorm
+            norm_layer=LayerNorm,
+            tgt_sizes=None
     ):
         super().__init__()
         self.num_queries = grid_size ** 2
         self.embed_dim = embed_dim
         self.num_heads = num_heads
 
-        self.pos_embed = nn.Parameter(
-            torch.from_numpy(get_2d_sincos_pos_embed(embed_dim, grid_size)).float()
-        ).requires_grad_(False)
+        self.register_buffer(
+            'pos_embed', get_2d_sincos_pos_embed_torch(embed_dim, grid_size))
+        # interpolate pos_embed up front for grid sizes known to come from the vision tower
+        for size in tgt_sizes or []:
+            self.register_buffer(f'pos_embed_{size}', get_abs_pos(self.pos_embed, size * size), persistent=False)
+        # (tgt_size, dtype, device) -> (key pos_embed, query pos_embed)
+        self._pos_embed_cache = {}
 
-        self.query = nn.Parameter(torch.zeros(self.num_queries, embed_dim))
+        self.query = nn.Parameter(torch.empty(self.num_queries, embed_dim))
         trunc_normal_(self.query, std=.02)
 
         if kv_dim is not None and kv_dim != embed_dim:
@@ -371,7 +535,7 @@ class QwenResampler(nn.Module):
         else:
             self.kv_proj = nn.Identity()
 
-        self.attn = nn.MultiheadAttention(embed_dim, num_heads)
+        self.attn = CrossAttention(embed_dim, num_heads)
         self.ln_q = norm_layer(embed_dim)
         self.ln_kv = norm_layer(embed_dim)
 
@@ -385,32 +549,51 @@ class QwenResampler(nn.Module):
             trunc_normal_(m.weight, std=.02)
             if isinstance(m, nn.Linear) and m.bias is not None:
                 nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
+        elif isinstance(m, (nn.LayerNorm, LayerNorm)):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
     def forward(self, x, attn_mask=None):
 
-        pos_embed = get_abs_pos(self.pos_embed, x.size(1))
+        pos_embed, query_pos_embed = self._get_pos_embed(x.size(1), x.dtype, x.device)
 
         x = self.src_kv_proj(x)
         x = self.kv_proj(x)
-        x = self.ln_kv(x).permute(1, 0, 2) # b n c -> n b c
+        x = self.ln_kv(x)
 
-        N = x.shape[1]
+        N = x.shape[0]
         q = self.ln_q(self.query)
         out = self.attn(
-            self._repeat(q, N) + self.pos_embed.to(x.dtype).unsqueeze(1),
-            x + pos_embed.to(x.dtype).unsqueeze(1),
+            self._repeat(q, N) + query_pos_embed,
+            x + pos_embed,
             x,
-            attn_mask=attn_mask)[0]
-        out = out.permute(1, 0, 2)
+            attn_mask=attn_mask)
         out = self.ln_post(out)
         out = out @ self.proj
         return out
 
     def _repeat(self, query, N: int):
-        return query.unsqueeze(1).repeat(1, N, 1)
+        return query.unsqueeze(0).expand(N, -1, -1)
+
+    def _get_pos_embed(self, tgt_size, dtype, device):
+        key = (tgt_size, dtype, device)
+        if key not in self._pos_embed_cache:
+            pos_embed = getattr(self, f'pos_embed_{int(math.sqrt(tgt_size))}', None)
+            if pos_embed is None:
+                pos_embed = get_abs_pos(self.pos_embed, tgt_size)
+            self._pos_embed_cache[key] = (
+                pos_embed.to(device=device, dtype=dtype).unsqueeze(0),
+                self.pos_embed.to(device=device, dtype=dtype).unsqueeze(0),
+            )
+        return self._pos_embed_cache[key]
+
+    def _apply(self, *args, **kwargs):
+        self._pos_embed_cache.clear()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._pos_embed_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
 
 
 class CompressProjector(nn.Module):
@@ -419,18 +602,16 @@ class CompressProjector(nn.Module):
         super(CompressProjector, self).__init__()
         self.mlp = mlp
         self.num_slot = num_slot
-        self.query = nn.Parameter(torch.zeros(num_slot, embed_dim))
+        self.query = nn.Parameter(torch.empty(num_slot, embed_dim))
         trunc_normal_(self.query, std=.02)
 
     def forward(self, inputs, projector=None):
         
         if type(inputs) is list:
             concat_images, concat_features = inputs
-            concat_combine = torch.cat(
-                [concat_images.reshape(-1, concat_images.shape[-1]), concat_features.reshape(-1, concat_features.shape[-1])], dim=0)
-            concat_combine = self.mlp(concat_combine)
-            concat_images = concat_combine[:concat_images.shape[0]*concat_images.shape[1]].contiguous().view(*concat_images.shape[:2], -1)
-            concat_features = concat_combine[concat_images.shape[0]*concat_images.shape[1]:].contiguous().view(*concat_features.shape[:2], -1)
+            # nn.Linear broadcasts over the leading dims, no need to flatten and re-split
+            concat_images = self.mlp(concat_images)
+            concat_features = self.mlp(concat_features)
             image_query = self.query.expand(concat_images.shape[0], -1, -1)
             concat_images = torch.cat([concat_images, image_query], dim=1)
             feature_query = self.query.expand(concat_features.shape[0], -1, -1)
@@ -486,39 +667,39 @@ class PoolProjector(nn.Module):
 
         # list of images and vary length videos
         if type(inputs) is list:
-            concat_combine = []
-            for item in inputs:
-                # item k c
-                t = item.shape[0] // self.resolution
-                c = item.shape[-1]
-                h = int(np.sqrt(self.resolution))
-                grid = int(np.sqrt(self.pool_num))
-                feat = item.view(t, self.resolution, c) # t k c
-                feat = feat.view(t, h, h, c)
-                feat = feat.view(t, grid, h//grid, grid, h//grid, c)
-                feat = feat.permute(0, 1, 3, 2, 4, 5).contiguous()
-                feat = feat.view(t, self.pool_num, self.resolution//self.pool_num, c)
-                slot = torch.mean(feat, dim=-2).view(t*self.pool_num, c) # tp c
-                slot_global = torch.mean(item, dim=0, keepdim=True) # 1 c
-                concat_feat = torch.cat([item, slot, slot_global], dim=0) # stage 2 tk+tp+1 c
-                # concat_feat = torch.cat([item, slot], dim=0) # stage 1 tk+tp c
-                concat_combine.append(concat_feat)
-            concat_proj = self.mlp(torch.cat(concat_combine, dim=0))
-            feat_index = 0
-            concat_result = []
-            for item in concat_combine:
-                concat_result.append(concat_proj[feat_index: feat_index+item.shape[0]]) # k c
-                feat_index += item.shape[0]
-            return concat_result
+            # all items are pooled in one batched pass, item i is tokens_i (t_i*k c)
+            c = inputs[0].shape[-1]
+            h = int(np.sqrt(self.resolution))
+            grid = int(np.sqrt(self.pool_num))
+            device = inputs[0].device
+            frames = [item.shape[0] // self.resolution for item in inputs]
+            num_items, num_frames = len(frames), sum(frames)
+            tokens = torch.cat(inputs, dim=0) # Tk c
+            feat = tokens.view(num_frames, grid, h//grid, grid, h//grid, c)
+            slot = torch.mean(feat, dim=(2, 4)).view(num_frames, self.pool_num, c) # T p c
+
+            # frames have equal token counts, so an item's global pool is the mean of its frame means
+            frames_t = torch.tensor(frames, device=device)
+            frame_item = torch.repeat_interleave(
+                torch.arange(num_items, device=device), frames_t, output_size=num_frames) # T
+            slot_global = torch.zeros(num_items, c, device=device, dtype=torch.float32)
+            slot_global.index_add_(0, frame_item, slot.float().mean(dim=1))
+            slot_global = (slot_global / frames_t.unsqueeze(1)).to(tokens.dtype) # n c
+
+            # interleave [tokens_i, slot_i, slot_global_i] per item in a single cat
+            slots = torch.split(slot.view(-1, c), [t * self.pool_num for t in frames], dim=0)
+            concat_combine = torch.cat(
+                [x for i in range(num_items) for x in (inputs[i], slots[i], slot_global[i:i+1])], dim=0)
+            concat_proj = self.mlp(concat_combine)
+            sizes = [t * (self.resolution + self.pool_num) + 1 for t in frames] # stage 2 tk+tp+1
+            return list(torch.split(concat_proj, sizes, dim=0))
 
         n, k, c = inputs.shape
         h = int(np.sqrt(self.resolution))
         grid = int(np.sqrt(self.pool_num))
-        maps = inputs.view(n, k//self.resolution, h, h, c)
-        maps = maps.view(n, k//self.resolution, grid, h//grid, grid, h//grid, c)
-        maps = maps.permute(0, 1, 2, 4, 3, 5, 6).contiguous()
-        maps = maps.view(n, k//self.resolution, self.pool_num, self.resolution//self.pool_num, c)
-        slot = torch.mean(maps, dim=-2).view(n, k//self.resolution*self.pool_num, c)
+        maps = inputs.view(n, k//self.resolution, grid, h//grid, grid, h//grid, c)
+        # average the within-cell dims directly, no permuted copy needed
+        slot = torch.mean(maps, dim=(3, 5)).view(n, k//self.resolution*self.pool_num, c)
         global_pool = torch.mean(inputs, dim=1, keepdim=True)
         output = self.mlp(torch.cat([inputs, slot, global_pool], dim=1)) # stage 2
         # output = self.mlp(torch.cat([inputs, slot], dim=1)) # stage 1
@@ -538,11 +719,9 @@ class BaseProjector(nn.Module):
             time_token = torch.mean(concat_features, dim=2) # n t c
             spatial_token = torch.mean(concat_features, dim=1) # n k c
             concat_features = torch.cat([time_token, spatial_token], dim=1) # n t+k c
-            concat_combine = torch.cat(
-                [concat_images.reshape(-1, concat_images.shape[-1]), concat_features.reshape(-1, concat_features.shape[-1])], dim=0)
-            concat_combine = self.mlp(concat_combine)
-            concat_images = concat_combine[:concat_images.shape[0]*concat_images.shape[1]].contiguous().view(*concat_images.shape[:2], -1)
-            concat_features = concat_combine[concat_images.shape[0]*concat_images.shape[1]:].contiguous().view(*concat_features.shape[:2], -1)
+            # nn.Linear broadcasts over the leading dims, no need to flatten and re-split
+            concat_images = self.mlp(concat_images)
+            concat_features = self.mlp(concat_features)
             return concat_images, concat_features
         
         if inputs.ndim == 3:
@@ -569,11 +748,9 @@ class BaseMixProjector(nn.Module):
             concat_images, concat_features = inputs
             n, t, k, c = concat_features.shape
             concat_features = concat_features.view(n, t*k, c) # n t*k c
-            concat_combine = torch.cat(
-                [concat_images.reshape(-1, concat_images.shape[-1]), concat_features.reshape(-1, concat_features.shape[-1])], dim=0)
-            concat_combine = self.mlp(concat_combine)
-            concat_images = concat_combine[:concat_images.shape[0]*concat_images.shape[1]].contiguous().view(*concat_images.shape[:2], -1)
-            concat_features = concat_combine[concat_images.shape[0]*concat_images.shape[1]:].contiguous().view(*concat_features.shape[:2], -1)
+            # nn.Linear broadcasts over the leading dims, no need to flatten and re-split
+            concat_images = self.mlp(concat_images)
+            concat_features = self.mlp(concat_features)
             return concat_images, concat_features
         
         if inputs.ndim == 3:
@@ -589,6 +766,10 @@ class BaseMixProjector(nn.Module):
 
 def build_vision_projector(config, delay_load=False, **kwargs):
     projector_type = getattr(config, 'mm_projector_type', 'linear')
+    # 'tanh' is cheaper than the exact erf form, but released checkpoints were trained with 'none'
+    gelu_approximate = getattr(config, 'mm_projector_gelu_approximate', 'none')
+    # opt-in torch.compile of the slot attention iterations
+    compile_slot = getattr(config, 'mm_projector_compile', False)
 
     if projector_type == 'linear':
         return nn.Linear(config.mm_hidden_size, config.hidden_size)
@@ -598,7 +779,7 @@ def build_vision_projector(config, delay_load=False, **kwargs):
         mlp_depth = int(mlp_gelu_match.group(1))
         modules = [nn.Linear(config.mm_hidden_size, config.hidden_size)]
         for _ in range(1, mlp_depth):
-            modules.append(nn.GELU())
+            modules.append(nn.GELU(approximate=gelu_approximate))
             modules.append(nn.Linear(config.hidden_size, config.hidden_size))
         return nn.Sequential(*modules)
 
@@ -606,7 +787,8 @@ def build_vision_projector(config, delay_load=False, **kwargs):
         return IdentityMap()
     
     if projector_type == 'slot':
-        return SlotAttention(config.n_slot, config.mm_hidden_size, 3, config.hidden_size, config.hidden_size)
+        return SlotAttention(config.n_slot, config.mm_hidden_size, 3, config.hidden_size, config.hidden_size,
+                             compile_step=compile_slot)
     
     if projector_type == 'perceiver':
         return PerceiverSampler(config.n_slot, config.mm_hidden_size, config.hidden_size)
@@ -615,17 +797,18 @@ def build_vision_projector(config, delay_load=False, **kwargs):
         mlp_depth = 2
         modules = [nn.Linear(config.mm_hidden_size, config.hidden_size)]
         for _ in range(1, mlp_depth):
-            modules.append(nn.GELU())
+            modules.append(nn.GELU(approximate=gelu_approximate))
             modules.append(nn.Linear(config.hidden_size, config.hidden_size))
         mlp = nn.Sequential(*modules)
-        sa = SlotAttention(config.n_slot, config.mm_hidden_size, 3, config.hidden_size, config.hidden_size)
+        sa = SlotAttention(config.n_slot, config.mm_hidden_size, 3, config.hidden_size, config.hidden_size,
+                           compile_step=compile_slot)
         return MultiProjector(mlp, sa)
     
     if projector_type == 'compress':
         mlp_depth = 2
         modules = [nn.Linear(4*config.mm_hidden_size, config.hidden_size)]
         for _ in range(1, mlp_depth):
-            modules.append(nn.GELU())
+            modules.append(nn.GELU(approximate=gelu_approximate))
             modules.append(nn.Linear(config.hidden_size, config.hidden_size))
         mlp = nn.Sequential(*modules)
         return CompressProjector(mlp, config.n_slot, config.hidden_size)
@@ -634,7 +817,7 @@ def build_vision_projector(config, delay_load=False, **kwargs):
         mlp_depth = 2
         modules = [nn.Linear(4*config.mm_hidden_size, config.hidden_size)]
         for _ in range(1, mlp_depth):
-            modules.append(nn.GELU())
+            modules.append(nn.GELU(approximate=gelu_approximate))
             modules.append(nn.Linear(config.hidden_size, config.hidden_size))
         mlp = nn.Sequential(*modules)
         pool_num = config.pool_num if hasattr(config, 'pool_num') else 1
@@ -644,7 +827,7 @@ def build_vision_projector(config, delay_load=False, **kwargs):
         mlp_depth = 2
         modules = [nn.Linear(config.mm_hidden_size, config.hidden_size)]
         for _ in range(1, mlp_depth):
-            modules.append(nn.GELU())
+            modules.append(nn.GELU(approximate=gelu_approximate))
             modules.append(nn.Linear(config.hidden_size, config.hidden_size))
         mlp = nn.Sequential(*modules)
         return BaseProjector(mlp)
@@ -653,13 +836,14 @@ def build_vision_projector(config, delay_load=False, **kwargs):
         mlp_depth = 2
         modules = [nn.Linear(4*config.mm_hidden_size, config.hidden_size)]
         for _ in range(1, mlp_depth):
-            modules.append(nn.GELU())
+            modules.append(nn.GELU(approximate=gelu_approximate))
             modules.append(nn.Linear(config.hidden_size, config.hidden_size))
         mlp = nn.Sequential(*modules)
         return BaseMixProjector(mlp)
 
     if projector_type == 'resampler':
-        return QwenResampler(int(math.sqrt(config.n_slot)), 4096, 4096//128, 1664, config.hidden_size, config.mm_hidden_size)
+        return QwenResampler(int(math.sqrt(config.n_slot)), 4096, 4096//128, 1664, config.hidden_size, config.mm_hidden_size,
+                             tgt_sizes=getattr(config, 'expected_tgt_sizes', None))
         # return Resampler(int(math.sqrt(config.n_slot)), config.hidden_size, config.hidden_size//128, config.mm_hidden_size)
 
     raise ValueError(f'Unknown projector type: {projector_type}')